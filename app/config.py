@@ -5,6 +5,63 @@ import os
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Драйвер psycopg3: postgresql:// -> postgresql+psycopg://
+if DATABASE_URL and DATABASE_URL.startswith(("postgresql://", "postgres://")):
+    DATABASE_URL = "postgresql+psycopg://" + DATABASE_URL.split("://", 1)[1]
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
+DB_IDLE_IN_TRANSACTION_TIMEOUT_MS = int(os.getenv("DB_IDLE_IN_TRANSACTION_TIMEOUT_MS", 30000))
+# Параметры сессии PostgreSQL для read-only подключений приложения
+DB_SESSION_OPTIONS = (
+    f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS} "
+    f"-c idle_in_transaction_session_timeout={DB_IDLE_IN_TRANSACTION_TIMEOUT_MS} "
+    "-c default_transaction_read_only=on"
+)
 LLM_API_KEY = os.getenv("LLM_API_KEY")
 LLM_API_URL = os.getenv("LLM_API_URL")
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL") or 'http://arch-ideapadg3:11434'
\ No newline at end of file
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 50000))
+# Кэш готовых ответов пайплайна по (запрос, язык, последняя пара диалога); 0 - отключен
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", 300))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 1024))
+# Максимум пользователей с историей диалога в памяти (вытесняются давно неактивные)
+HISTORY_MAX_USERS = int(os.getenv("HISTORY_MAX_USERS", 10000))
+# История пользователя удаляется после стольких секунд без новых сообщений
+HISTORY_TTL_SECONDS = int(os.getenv("HISTORY_TTL_SECONDS", 3600))
+# Бюджет истории диалога в промпте (токены ~ символы / 4): старые пары сворачиваются в краткую сводку
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 8000))
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", 2000))
+# TTL кэша контекста Gemini (system prompt со схемой хранится на стороне API)
+LLM_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("LLM_CONTEXT_CACHE_TTL_SECONDS", 3600))
+# Генерация SQL параллельно с проверкой ясности и формата (лишний вызов Gemini, если нужно уточнение)
+LLM_SPECULATIVE_SQL = os.getenv("LLM_SPECULATIVE_SQL", "1").lower() not in ("0", "false", "no")
+# Ясность, формат и SQL одним вызовом Gemini вместо трех (0 - отдельные вызовы, как раньше)
+LLM_FUSED_PIPELINE = os.getenv("LLM_FUSED_PIPELINE", "1").lower() not in ("0", "false", "no")
+# Семантический кэш ответов пайплайна: эмбеддинги запросов Gemini и порог косинусного сходства
+LLM_EMBEDDING_MODEL = os.getenv("LLM_EMBEDDING_MODEL", "gemini-embedding-001")
+LLM_EMBEDDING_DIM = int(os.getenv("LLM_EMBEDDING_DIM", 768))
+# Семантический кэш ответов для запросов без контекста диалога; SEMANTIC_CACHE_MAX_ENTRIES=0 - отключен
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 10000))
+# Проверки ясности и формата параллельно с поиском в семантическом кэше (лишние вызовы Gemini при попадании)
+SEMANTIC_CACHE_PARALLEL_LOOKUP = os.getenv("SEMANTIC_CACHE_PARALLEL_LOOKUP", "1").lower() not in ("0", "false", "no")
+# Уровень логирования приложения (записи пишутся в stdout фоновым потоком QueueListener)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL") or 'http://arch-ideapadg3:11434'
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", 60))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", 32))
+# Сколько секунд простаивающее соединение с Ollama остается в пуле (у httpx по умолчанию 5 с:
+# при редких запросах каждый открывал бы новое TCP соединение)
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", 300))
+# Сколько Ollama держит модель в памяти после запроса (keep_alive): вместе с моделью сохраняется
+# KV кэш промпта, и следующий запрос с тем же префиксом не вычисляет его заново
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Окно контекста модели Ollama в токенах; потоки CPU для инференса (0 - выбор Ollama по числу физических ядер)
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", 8192))
+OLLAMA_NUM_THREAD = int(os.getenv("OLLAMA_NUM_THREAD", 0))
+# Модель эмбеддингов Ollama для семантического кэша SQL локального движка (например nomic-embed-text);
+# пусто - кэш отключен: модель должна быть загружена в Ollama, иначе каждый запрос получал бы ошибку
+OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "")
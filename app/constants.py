@@ -1,10 +1,52 @@
-import json
+import orjson
+import re
+from typing import Dict
 
 
 DEFAULT_LIMIT = 1000
 AGGREGATION_THRESHOLD = 10000
 MAX_RETRIES = 3
 
+# Определение языка запроса: специфичные казахские буквы, кириллица и казахские слова.
+# Слова ищутся целиком (\b): подстроки "не", "бар", "саны" встречаются в русских словах ("неделю").
+# Буквы в обоих регистрах и поиск слов без учета регистра - проверкам не нужна копия text.lower()
+KAZAKH_CHARS = frozenset('әғқңөұүһіӘҒҚҢӨҰҮҺІ')
+CYRILLIC_RE = re.compile(r'[\u0400-\u04FF]')
+KAZAKH_WORDS_RE = re.compile(
+    r'\b(?:қанша|неше|қайда|қашан|кім|не|бар|жоқ|саны|жылы|айы|транзакциялар|мерчанттар)\b',
+    re.IGNORECASE
+)
+
+# Значения, которыми различаются запросы одной формы: семантический кэш принимает попадание только при
+# совпадении этих значений ("в Алматы за март" и "в Астане за март" близки по эмбеддингу, но SQL у них разный).
+# Кавычки и числа (в том числе части дат) - как есть; слова - по основе (stem), чтобы падежи совпадали:
+# города, месяцы, периоды, агрегаты, значения столбцов-перечислений схемы
+QUERY_LITERAL_RE = re.compile(
+    r"'[^']*'|\"[^\"]*\"|«[^»]*»|\d+(?:[.,]\d+)?"
+    r"|\b(?P<stem>"
+    # Города
+    r"астан|алмат|шымкент|astana|almaty|shymkent|other|друг"
+    # Месяцы (ru, kk, en)
+    r"|январ|феврал|март|апрел|ма[йяюе]|июн|июл|август|сентябр|октябр|ноябр|декабр"
+    r"|қаңтар|ақпан|наурыз|сәуір|мамыр|маусым|шілде|тамыз|қыркүйек|қазан|қараша|желтоқсан"
+    r"|january|february|march|april|may|june|july|august|september|october|november|december"
+    # Периоды и их модификаторы
+    r"|сегодня|вчера|прошл|текущ|последн|этот|этом|эту|недел|месяц|квартал|год|лет|день|дня|дней|час"
+    r"|бүгін|кеше|өткен|осы|соңғы|апта|жыл|күн|ай"
+    r"|today|yesterday|last|previous|this|current|week|month|quarter|year|day|hour"
+    # Агрегаты и сортировка
+    r"|сумм|средн|количеств|сколько|максим|миним|больш|меньш|топ|сома|орташа|қанша|ең"
+    r"|sum|total|average|avg|count|how many|max|min|top|most|least|more|less"
+    # Значения transaction_type, pos_entry_mode, wallet_type и категорий MCC
+    r"|pos|atm|ecom|p2p|salary|bill|chip|qr|contactless|swipe|samsung|google|apple"
+    r"|clothing|dining|electronics|fuel|retail|grocery|hobby|home|pharmac|services|travel|utilit"
+    r"|одежд|ресторан|электрон|топлив|продукт|аптек|путешеств|коммунал|снят|перевод|зарплат|оплат"
+    r")\w*",
+    re.IGNORECASE
+)
+# Латинские слова в кириллическом запросе - названия (банки, мерчанты): тоже значения запроса
+LATIN_WORD_RE = re.compile(r"\b[A-Za-z][A-Za-z&'-]*\b")
+
 TABLE_SCHEMA = {
     "id": "Integer primary key",
     "transaction_id": "String transaction identifier",
@@ -25,6 +67,86 @@ TABLE_SCHEMA = {
     "wallet_type": "String wallet type. Only this values: (Bank's QR, Samsung Pay, Google Pay, Apple Pay)"
 }
 
+# Materialized view с дневными агрегатами (создается и обновляется create_rollups.py)
+ROLLUP_VIEW = "tx_daily"
+ROLLUP_SCHEMA = {
+    "day": "Timestamp truncated to day (date_trunc('day', transaction_timestamp))",
+    "merchant_city": "String merchant city, same values as transactions.merchant_city",
+    "mcc_category": "String mcc category, same values as transactions.mcc_category",
+    "transaction_type": "String type of transaction, same values as transactions.transaction_type",
+    "total_amount_kzt": "Numeric SUM(transaction_amount_kzt) for the day and group",
+    "transaction_count": "Integer COUNT(*) of transactions for the day and group"
+}
+
+# Статические переводы столбцов схемы и частых алиасов из примеров: применяются без вызова LLM,
+# в модель уходят только остальные
+STATIC_COLUMN_TRANSLATIONS: Dict[str, Dict[str, str]] = {
+    "ru": {
+        "transaction_count": "Количество транзакций",
+        "merchant_id": "ID мерчанта",
+        "total_amount": "Общая сумма",
+        "avg_amount": "Средняя сумма",
+        "transaction_amount_kzt": "Сумма транзакции (KZT)",
+        "mcc_category": "Категория MCC",
+        "merchant_city": "Город мерчанта",
+        "transaction_year": "Год транзакции",
+        "transaction_month": "Месяц транзакции",
+        "total_transactions": "Количество транзакций",
+        "total_amount_kzt": "Общая сумма (KZT)",
+        "transaction_id": "ID транзакции",
+        "transaction_timestamp": "Время транзакции",
+        "card_id": "ID карты",
+        "issuer_bank_name": "Банк-эмитент",
+        "merchant_mcc": "MCC мерчанта",
+        "transaction_type": "Тип транзакции",
+        "original_amount": "Исходная сумма",
+        "transaction_currency": "Валюта транзакции",
+        "acquirer_country_iso": "Страна эквайера",
+        "pos_entry_mode": "Способ ввода POS",
+        "wallet_type": "Тип кошелька",
+        "total_volume": "Общий объем",
+        "total_volume_kzt": "Общий объем (KZT)",
+        "average_amount": "Средняя сумма",
+        "total_revenue": "Общая выручка",
+        "month": "Месяц",
+        "day": "День",
+    },
+    "kk": {
+        "transaction_count": "Транзакциялар саны",
+        "merchant_id": "Мерчант ID",
+        "total_amount": "Жалпы сома",
+        "avg_amount": "Орташа сома",
+        "transaction_amount_kzt": "Транзакция сомасы (KZT)",
+        "mcc_category": "MCC санаты",
+        "merchant_city": "Мерчант қаласы",
+        "transaction_year": "Транзакция жылы",
+        "transaction_month": "Транзакция айы",
+        "total_transactions": "Транзакциялар саны",
+        "total_amount_kzt": "Жалпы сома (KZT)",
+        "transaction_id": "Транзакция ID",
+        "transaction_timestamp": "Транзакция уақыты",
+        "card_id": "Карта ID",
+        "issuer_bank_name": "Эмитент банк",
+        "merchant_mcc": "Мерчант MCC",
+        "transaction_type": "Транзакция түрі",
+        "original_amount": "Бастапқы сома",
+        "transaction_currency": "Транзакция валютасы",
+        "acquirer_country_iso": "Эквайер елі",
+        "pos_entry_mode": "POS енгізу тәсілі",
+        "wallet_type": "Әмиян түрі",
+        "total_volume": "Жалпы көлем",
+        "total_volume_kzt": "Жалпы көлем (KZT)",
+        "average_amount": "Орташа сома",
+        "total_revenue": "Жалпы түсім",
+        "month": "Ай",
+        "day": "Күн",
+    },
+}
+
+# Сериализуется один раз при импорте; компактная форма экономит токены промпта
+TABLE_SCHEMA_JSON = orjson.dumps(TABLE_SCHEMA).decode()
+ROLLUP_SCHEMA_JSON = orjson.dumps(ROLLUP_SCHEMA).decode()
+
 PRODUCTION_SYSTEM_PROMPT = f"""
 SYSTEM_ROLES:
 - Data Analyst Assistant
@@ -45,6 +167,9 @@ POSTGRES_OPTIMIZATION:
 - Используй EXPLAIN ANALYZE для сложных запросов
 - Применяй индексные подсказки (merchant_city, transaction_timestamp)
 - Ограничивай результат LIMIT {DEFAULT_LIMIT} если не указано иное
+- Сырые строки по времени сортируй ORDER BY transaction_timestamp DESC, id DESC (индекс (transaction_timestamp, id))
+- Никогда не используй OFFSET для постраничной выборки - только keyset по (transaction_timestamp, id):
+  SELECT * FROM transactions WHERE (transaction_timestamp, id) < ('2024-06-01 00:00:00', 125000) ORDER BY transaction_timestamp DESC, id DESC LIMIT 100
 - Используй WITH для сложных агрегаций
 
 ERROR_HANDLING:
@@ -61,5 +186,37 @@ Amounts filtered through transaction_amount_kzt.
 String filters must use ILIKE.
 
 Table schema:
-{json.dumps(TABLE_SCHEMA, indent=2)}
-"""
\ No newline at end of file
+{TABLE_SCHEMA_JSON}
+"""
+
+# Раздел о дневных агрегатах: добавляется в промпт генерации SQL, только если при старте сервера
+# materialized view найден в БД (создается и обновляется create_rollups.py)
+ROLLUP_PROMPT_SECTION = f"""
+Pre-aggregated daily rollup '{ROLLUP_VIEW}' (materialized view over transactions):
+{ROLLUP_SCHEMA_JSON}
+Prefer '{ROLLUP_VIEW}' over 'transactions' for SUM/COUNT grouped by day, month or year
+and filtered only by merchant_city, mcc_category, transaction_type (filter dates through "day").
+Use 'transactions' for any other column, raw rows, averages or distinct counts.
+"""
+
+_SQL_GENERATION_RULES = f"""
+SQL_GENERATION_RULES:
+Generate optimized PostgreSQL SELECT query с учетом контекста предыдущих запросов:
+- Use indexes on merchant_city, transaction_timestamp
+- Add WHERE conditions before JOINs
+- Include LIMIT {DEFAULT_LIMIT} if aggregating large datasets
+- Validate against user intent
+- Only SELECT queries allowed
+- Учитывай контекст предыдущих сообщений при интерпретации запроса
+
+КРИТИЧЕСКИ ВАЖНО:
+- Все названия столбцов в SQL запросе ДОЛЖНЫ быть на английском языке
+- Используй английские названия для AS алиасов: transaction_year, transaction_month, total_count, total_amount
+- НЕ используй кириллицу или казахские символы в названиях столбцов SQL
+- Примеры правильных названий: transaction_year, transaction_month, total_transactions, total_amount_kzt
+"""
+
+# Системный промпт генерации SQL: схема и роли из PRODUCTION_SYSTEM_PROMPT плюс постоянные правила
+# генерации - кэшируется в Gemini целиком, в запросе остаются только данные пользователя
+SQL_GENERATION_SYSTEM_PROMPT = PRODUCTION_SYSTEM_PROMPT + _SQL_GENERATION_RULES
+SQL_GENERATION_SYSTEM_PROMPT_WITH_ROLLUP = PRODUCTION_SYSTEM_PROMPT + ROLLUP_PROMPT_SECTION + _SQL_GENERATION_RULES
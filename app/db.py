@@ -1,41 +1,65 @@
-from sqlalchemy import create_engine, select
-from sqlalchemy.orm import sessionmaker
-from config import DATABASE_URL
+from sqlalchemy import create_engine, select, func
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_SESSION_OPTIONS
 from models import Transaction
 
+# Один engine (и пул соединений) на процесс, общий для всех экземпляров ReadOnlyDB
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(
+            DATABASE_URL,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=True,  # проверка соединения перед выдачей из пула (PG idle timeout)
+            pool_recycle=DB_POOL_RECYCLE,
+            # prepare_threshold=0 — серверные prepared statements с первого выполнения
+            connect_args={
+                "prepare_threshold": 0,
+                "options": DB_SESSION_OPTIONS
+            },
+        )
+    return _engine
+
+
 class ReadOnlyDB:
     def __init__(self, batch_size=1_000_000):
-        self.engine = create_engine(DATABASE_URL)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = get_engine()
         self.batch_size = batch_size  # лимит батча по умолчанию
 
-    def read_batch(self, offset=0, limit=None):
+    def read_batch(self, after_id=None, limit=None):
         """
         Чтение данных батчами по умолчанию из Transaction.
-        offset — с какой id начинать
+        after_id — id последней прочитанной записи (keyset), если None — с начала таблицы
         limit — сколько строк читать, если None — берется batch_size
+        Возвращает Core Row кортежи (без ORM-гидрации и identity map).
         """
         limit = limit or self.batch_size
-        with self.Session() as session:
-            stmt = select(Transaction).order_by(Transaction.id).offset(offset).limit(limit)
-            return session.execute(stmt).scalars().all()
+        stmt = select(*Transaction.__table__.c).order_by(Transaction.id).limit(limit)
+        if after_id is not None:
+            stmt = stmt.where(Transaction.id > after_id)
+        with self.engine.connect() as connection:
+            return connection.execute(stmt).all()
 
     def count(self):
         """Количество записей в таблице"""
-        with self.Session() as session:
-            return session.query(Transaction).count()
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(Transaction.__table__)).scalar()
 
     def execute_select(self, stmt):
         """
         Принимает любое SQLAlchemy select выражение.
         Возвращает генератор батчей по batch_size, чтобы не грузить память.
+        Запрос выполняется один раз через серверный курсор (stream_results),
+        батчи — списки Core Row без ORM-гидрации объектов.
         """
-        with self.Session() as session:
-            offset = 0
-            while True:
-                batch_stmt = stmt.offset(offset).limit(self.batch_size)
-                results = session.execute(batch_stmt).scalars().all()
-                if not results:
-                    break
-                yield results
-                offset += self.batch_size
+        with self.engine.connect().execution_options(
+            stream_results=True,
+            yield_per=self.batch_size
+        ) as connection:
+            result = connection.execute(stmt)
+            for partition in result.partitions():
+                yield partition
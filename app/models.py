@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, Numeric, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Numeric, TIMESTAMP, Index
 from typing import Literal, Optional, List, Dict, Any
 from pydantic import BaseModel, Field
 
@@ -20,13 +20,23 @@ class Transaction(Base):
     mcc_category = Column(String)
     merchant_city = Column(String)
     transaction_type = Column(String)
-    transaction_amount_kzt = Column(Numeric)
-    original_amount = Column(Numeric, nullable=True)
+    # asdecimal=False — значения приходят как float, как в TransactionSchema. psycopg по-прежнему отдает
+    # Decimal для numeric, SQLAlchemy переводит его в float при обработке каждой строки (не бесплатно)
+    transaction_amount_kzt = Column(Numeric(18, 2, asdecimal=False))
+    original_amount = Column(Numeric(18, 2, asdecimal=False), nullable=True)
     transaction_currency = Column(String)
     acquirer_country_iso = Column(String)
     pos_entry_mode = Column(String)
     wallet_type = Column(String)
 
+    # Составные индексы под типовые фильтры сгенерированного SQL (период + город/категория/тип)
+    __table_args__ = (
+        Index("ix_tx_ts_id", "transaction_timestamp", "id"),
+        Index("ix_tx_city_ts", "merchant_city", "transaction_timestamp"),
+        Index("ix_tx_mcc_ts", "mcc_category", "transaction_timestamp"),
+        Index("ix_tx_type_ts", "transaction_type", "transaction_timestamp"),
+    )
+
 # Pydantic схемы согласно контракту
 MCC_CATEGORIES = Literal[
     "Clothing & Apparel", "Dining & Restaurants", "Electronics & Software",
@@ -73,17 +83,48 @@ class FormatDecision(BaseModel):
     clarification_question: Optional[str] = None
     refined_query: str
 
+class ClarityCheck(BaseModel):
+    is_clear: bool
+    clarification_question: Optional[str] = None
+
+# Элементы батчевых ответов: id - идентификатор запроса из промпта, результаты сопоставляются только по нему
+class BatchedFormatDecision(FormatDecision):
+    id: str
+
+class BatchedClarityCheck(ClarityCheck):
+    id: str
+
+class SQLGeneration(BaseModel):
+    sql_query: str
+    explanation: str
+    estimated_performance: Literal["good", "medium", "poor"]
+    summary_template: Optional[str] = None
+
+class CombinedDecision(BaseModel):
+    """Ясность, формат и SQL одним вызовом Gemini"""
+    is_clear: bool
+    clarification_question: Optional[str] = None
+    output_format: Literal["text", "table", "graph", "diagram"]
+    confidence_score: float = Field(ge=0, le=1)
+    refined_query: str
+    sql_query: Optional[str] = None
+    explanation: str = ""
+    estimated_performance: Literal["good", "medium", "poor"] = "good"
+    summary_template: Optional[str] = None
+
 class SQLValidation(BaseModel):
     sql_query: str
     is_safe: bool
     matches_intent: bool
     validation_notes: str
     alternative_query: Optional[str] = None
+    summary_template: Optional[str] = None  # Шаблон текстового ответа с {столбцами} результата
 
 class ExecutionResult(BaseModel):
     data: List[Dict[str, Any]]
     row_count: int
     execution_time_ms: float
+    truncated: bool = False  # Результат обрезан до MAX_RESULT_ROWS
 
 class FinalResponse(BaseModel):
     content: str
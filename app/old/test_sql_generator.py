@@ -2,6 +2,7 @@
 Консольное приложение для преобразования текстовых запросов в SQL через Gemini API.
 """
 import os
+import re
 from google import genai
 from app.config import LLM_API_KEY
 from app.models import Transaction
@@ -10,13 +11,15 @@ from app.sql_to_db import execute_sql_query
 # Загружаем переменные окружения
 client = genai.Client(api_key=LLM_API_KEY)
 
+# Markdown-блок кода вокруг ответа модели: ```sql ... ``` или ``` ... ```
+# (обе ограды необязательны - regex совпадает с любым ответом и только снимает их)
+_FENCE_RE = re.compile(r"^\s*(?:```(?:sql\b)?)?\s*(.*?)\s*(?:```\s*)?$", re.DOTALL | re.IGNORECASE)
+
 
 # Глобальная переменная для клиента (будет инициализирована в main)
 
-def get_table_schema_prompt():
-    """
-    Формирует описание структуры таблицы для контекста Gemini.
-    """
+def _build_schema_prompt():
+    """Формирует описание структуры таблицы для контекста Gemini"""
     schema = f"""
 Таблица: {Transaction.__tablename__}
 
@@ -53,6 +56,17 @@ def get_table_schema_prompt():
 """
     return schema
 
+
+# Описание таблицы и обрамление запроса пользователя не зависят от запроса - строятся один раз при импорте
+_SCHEMA_PROMPT = _build_schema_prompt()
+_FULL_PROMPT_PREFIX = f"{_SCHEMA_PROMPT}\n\nЗапрос пользователя: "
+_FULL_PROMPT_SUFFIX = "\n\nСгенерируй SQL запрос для выполнения этого запроса. Верни только SQL запрос, без дополнительных объяснений."
+
+
+def get_table_schema_prompt():
+    """Описание структуры таблицы для контекста Gemini (готовая строка)"""
+    return _SCHEMA_PROMPT
+
 def generate_sql(user_query: str) -> str:
     """
     Генерирует SQL запрос на основе текстового запроса пользователя.
@@ -66,13 +80,7 @@ def generate_sql(user_query: str) -> str:
     if client is None:
         return "Ошибка: Клиент Gemini не инициализирован. Проверьте наличие API ключа."
     
-    schema_prompt = get_table_schema_prompt()
-    
-    full_prompt = f"""{schema_prompt}
-
-Запрос пользователя: {user_query}
-
-Сгенерируй SQL запрос для выполнения этого запроса. Верни только SQL запрос, без дополнительных объяснений."""
+    full_prompt = _FULL_PROMPT_PREFIX + user_query + _FULL_PROMPT_SUFFIX
 
     try:
         response = client.models.generate_content(
@@ -80,17 +88,8 @@ def generate_sql(user_query: str) -> str:
             contents=full_prompt
         )
         
-        sql_query = response.text.strip()
-        
-        # Очищаем SQL от возможных markdown форматирования
-        if sql_query.startswith("```sql"):
-            sql_query = sql_query[6:]
-        if sql_query.startswith("```"):
-            sql_query = sql_query[3:]
-        if sql_query.endswith("```"):
-            sql_query = sql_query[:-3]
-        
-        return sql_query.strip()
+        # Очищаем SQL от возможных markdown форматирования одним regex (вместе с пробелами по краям)
+        return _FENCE_RE.match(response.text).group(1)
     
     except Exception as e:
         return f"Ошибка при генерации SQL: {str(e)}"
@@ -2,6 +2,14 @@ import re
 from typing import List, Set
 from app.models import SQLValidation
 
+# Стоп-слова для извлечения ключевых слов интента
+_STOP_WORDS = frozenset({
+    "the", "a", "an", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by",
+    "как", "что", "где", "когда", "какой", "какая", "какие", "какое", "какую", "какого"
+})
+# Слова от 3 символов: латиница, цифры, _ и кириллица (включая казахские буквы)
+_WORD_RE = re.compile(r'[0-9A-Za-z_\u0400-\u04FF]{3,}')
+
 class SecurityException(Exception):
     """Исключение для нарушений безопасности SQL"""
     pass
@@ -9,6 +17,9 @@ class SecurityException(Exception):
 class SecurityValidator:
     """Валидатор безопасности SQL запросов"""
     
+    # Состояния нет: паттерны - на уровне класса, экземпляр не нуждается в __dict__
+    __slots__ = ()
+    
     DANGEROUS_PATTERNS = [
         r"\b(INSERT|UPDATE|DELETE|DROP|ALTER|CREATE|TRUNCATE)\b",
         r";\s*(\w|\s)*$",  # Multiple statements
@@ -17,6 +28,11 @@ class SecurityValidator:
         r"\b(SLEEP|BENCHMARK|WAITFOR)\b"
     ]
     
+    # Компилируются один раз при загрузке класса
+    COMPILED_PATTERNS = [(pattern, re.compile(pattern, re.IGNORECASE)) for pattern in DANGEROUS_PATTERNS]
+    # Все паттерны в одной альтернации: безопасный запрос проверяется за один проход
+    FUSED_PATTERN = re.compile("|".join(f"(?:{pattern})" for pattern in DANGEROUS_PATTERNS), re.IGNORECASE)
+    
     def validate_sql(self, sql: str, user_intent: str) -> SQLValidation:
         """
         Валидация SQL запроса на безопасность и соответствие интенту
@@ -30,10 +46,12 @@ class SecurityValidator:
         is_safe = True
         security_notes = []
         
-        for pattern in self.DANGEROUS_PATTERNS:
-            if re.search(pattern, sql, re.IGNORECASE):
-                is_safe = False
-                security_notes.append(f"Обнаружен опасный паттерн: {pattern}")
+        # Поштучная проверка только если общий паттерн сработал — для точных заметок
+        if self.FUSED_PATTERN.search(sql):
+            for pattern, compiled in self.COMPILED_PATTERNS:
+                if compiled.search(sql):
+                    is_safe = False
+                    security_notes.append(f"Обнаружен опасный паттерн: {pattern}")
         
         # Проверка что это SELECT запрос
         # if not sql_upper.startswith(("SELECT", "WITH")):
@@ -59,26 +77,36 @@ class SecurityValidator:
     def _extract_keywords(self, text: str) -> Set[str]:
         """Извлечение ключевых слов из текста"""
         # Удаляем стоп-слова и извлекаем значимые слова
-        stop_words = {"the", "a", "an", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by", "как", "что", "где", "когда", "какой", "какая", "какие", "какое", "какую", "какого", "какой", "какую", "какие", "какое", "какого", "какой", "какую", "какие", "какое", "какого"}
-        words = re.findall(r'\b\w+\b', text.lower())
-        return {w for w in words if len(w) > 2 and w not in stop_words}
+        return set(_WORD_RE.findall(text.lower())) - _STOP_WORDS
     
     def _matches_intent(self, sql: str, user_intent: str) -> bool:
         """
         Проверка соответствия SQL запроса намерению пользователя
         Базовая проверка по ключевым словам
         """
+        # Два ключевых слова (от 3 символов) с разделителем требуют минимум 7 символов -
+        # более короткий интент заведомо слишком общий, токенизировать его не нужно
+        if len(user_intent) < 7:
+            return True
+        
         intent_keywords = self._extract_keywords(user_intent)
-        sql_lower = sql.lower()
         
         # Если интент пустой или слишком общий, считаем что соответствует
         if len(intent_keywords) < 2:
             return True
         
-        # Проверяем наличие ключевых слов из интента в SQL
+        # Проверяем наличие ключевых слов из интента в SQL как подстрок ("amount" в transaction_amount_kzt).
+        # Целые токены SQL находятся пересечением множеств, поиск подстроки - только для оставшихся слов
         # (упрощенная проверка - можно улучшить с помощью LLM)
-        matched_keywords = sum(1 for keyword in intent_keywords if keyword in sql_lower)
+        sql_lower = sql.lower()
+        exact_matches = intent_keywords & set(_WORD_RE.findall(sql_lower))
+        matched_keywords = len(exact_matches) + sum(
+            1 for keyword in intent_keywords - exact_matches if keyword in sql_lower
+        )
         
-        # Если совпало больше половины ключевых слов, считаем что соответствует
-        return matched_keywords >= len(intent_keywords) * 0.3
+        # Если совпало не меньше 30% ключевых слов, считаем что соответствует (целочисленно)
+        return 10 * matched_keywords >= 3 * len(intent_keywords)
+
 
+# Общий экземпляр на процесс: движки text2sql и исполнитель запросов используют один валидатор
+security_validator = SecurityValidator()
@@ -0,0 +1,119 @@
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.constants import CYRILLIC_RE, LATIN_WORD_RE, QUERY_LITERAL_RE
+
+# Начальная емкость буфера языка: матрица растет удвоением до max_entries, а не выделяется сразу целиком
+INITIAL_BUCKET_CAPACITY = 64
+
+
+def query_literals(text: str) -> Tuple[str, ...]:
+    """
+    Значения запроса (числа, строки в кавычках, основы слов-значений, латинские названия в кириллическом
+    запросе) без учета порядка: попадание в семантический кэш допустимо только при их совпадении
+    """
+    literals = [
+        (match.group("stem") or match.group(0)).lower() for match in QUERY_LITERAL_RE.finditer(text)
+    ]
+    if CYRILLIC_RE.search(text):
+        literals.extend(word.lower() for word in LATIN_WORD_RE.findall(text))
+    return tuple(sorted(literals))
+
+
+class _LanguageBucket:
+    """Кольцевой буфер нормированных эмбеддингов одного языка, значений запросов и сохраненных значений"""
+    
+    def __init__(self, dim: int, capacity: int):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.literals: List[Tuple[str, ...]] = [()] * capacity
+        self.values: List[Any] = [None] * capacity
+        self.size = 0
+        self.next_index = 0
+    
+    def grow(self, capacity: int):
+        """Увеличение емкости до capacity с сохранением записей (только пока буфер не стал кольцевым)"""
+        extra = capacity - self.vectors.shape[0]
+        self.vectors = np.concatenate((self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)))
+        self.created_at = np.concatenate((self.created_at, np.zeros(extra, dtype=np.float64)))
+        self.literals.extend([()] * extra)
+        self.values.extend([None] * extra)
+
+
+class SemanticCache:
+    """
+    Семантический кэш: по эмбеддингу запроса находит ранее обработанный
+    похожий запрос (косинусное сходство >= threshold) того же языка с теми же значениями (query_literals).
+    Каждый язык хранится отдельно, при переполнении вытесняются самые старые записи.
+    """
+    
+    def __init__(self, threshold: float, max_entries: int, ttl_seconds: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._buckets: Dict[str, _LanguageBucket] = {}
+    
+    @staticmethod
+    def _normalize(vector) -> Optional[np.ndarray]:
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if not norm:
+            return None
+        return vec / norm
+    
+    def lookup(self, lang: str, vector, literals: Tuple[str, ...]) -> Optional[Any]:
+        """Значение самого похожего не истекшего запроса с теми же значениями или None"""
+        bucket = self._buckets.get(lang)
+        vec = self._normalize(vector)
+        if bucket is None or vec is None or not bucket.size or vec.shape[0] != bucket.vectors.shape[1]:
+            return None
+        
+        # Один матрично-векторный проход по всем записям языка
+        similarities = bucket.vectors[:bucket.size] @ vec
+        similarities[bucket.created_at[:bucket.size] < time.time() - self.ttl_seconds] = -1.0
+        # Кандидаты выше порога - по убыванию сходства; первый с совпадающими значениями
+        candidates = np.flatnonzero(similarities >= self.threshold)
+        for index in candidates[np.argsort(-similarities[candidates])]:
+            if bucket.literals[index] == literals:
+                return bucket.values[index]
+        return None
+    
+    def add(self, lang: str, vector, value: Any, literals: Tuple[str, ...]):
+        # max_entries <= 0 - кэш отключен: буфер нулевой емкости не создается
+        if self.max_entries <= 0:
+            return
+        vec = self._normalize(vector)
+        if vec is None:
+            return
+        bucket = self._buckets.get(lang)
+        if bucket is None or vec.shape[0] != bucket.vectors.shape[1]:
+            bucket = _LanguageBucket(vec.shape[0], min(INITIAL_BUCKET_CAPACITY, self.max_entries))
+            self._buckets[lang] = bucket
+        
+        index = bucket.next_index
+        capacity = bucket.vectors.shape[0]
+        if index == capacity and capacity < self.max_entries:
+            bucket.grow(min(capacity * 2, self.max_entries))
+        elif index == capacity:
+            index = 0
+        bucket.vectors[index] = vec
+        bucket.created_at[index] = time.time()
+        bucket.literals[index] = literals
+        bucket.values[index] = value
+        bucket.next_index = index + 1
+        bucket.size = min(bucket.size + 1, self.max_entries)
+    
+    def discard(self, predicate: Callable[[Any], bool]):
+        """Удаление записей, значение которых удовлетворяет predicate: запись помечается истекшей"""
+        for bucket in self._buckets.values():
+            for index in range(bucket.size):
+                value = bucket.values[index]
+                if value is not None and predicate(value):
+                    bucket.created_at[index] = 0.0
+                    bucket.literals[index] = ()
+                    bucket.values[index] = None
+    
+    def clear(self):
+        self._buckets.clear()
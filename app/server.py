@@ -1,18 +1,86 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+import logging
+import logging.handlers
+import queue
+import string
+import time
+from contextlib import asynccontextmanager
+
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from app.text2sql import build_text2sql
 from app.text2sql_local import build_text2sql_local
-from app.sql_to_db import execute_sql_query
+from app.sql_to_db import (
+    execute_sql_query, stream_execute_sql_query, rollup_view_exists, QueryTimeoutException, engine as db_engine
+)
 from app.models import UserQuery, FinalResponse
 from app.security_validator import SecurityException
+from app.config import LOG_LEVEL
+
+logger = logging.getLogger(__name__)
+
+
+def _start_log_listener() -> logging.handlers.QueueListener:
+    """
+    Неблокирующее логирование: обработчики запросов только кладут запись в очередь,
+    запись в stdout выполняет фоновый поток QueueListener
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Создание движков text2sql и кэша контекста Gemini, проверка view дневных агрегатов и прогрев соединений
+    с БД и Ollama при старте, закрытие соединений при остановке. Движки создаются один раз и общие для всех маршрутов.
+    """
+    log_listener = _start_log_listener()
+    app.state.api_engine = build_text2sql()
+    app.state.llm_engine = build_text2sql_local()
+    # Проверка view заодно прогревает пул соединений с БД; без view промпты его не упоминают
+    rollup_available = False
+    try:
+        rollup_available = await rollup_view_exists()
+    except Exception as e:
+        logger.warning("Could not warm up DB connection pool: %s", e)
+    if not rollup_available:
+        logger.info("Rollup view not found, SQL prompts use only the transactions table")
+    try:
+        await app.state.api_engine.warm_up(rollup_available)
+    except Exception as e:
+        logger.warning("Could not create Gemini context cache: %s", e)
+    try:
+        await app.state.llm_engine.warm_up(rollup_available)
+    except Exception as e:
+        logger.warning("Could not warm up Ollama connection: %s", e)
+    yield
+    await app.state.llm_engine.aclose()
+    await db_engine.dispose()
+    log_listener.stop()
 
-app = FastAPI()
 
-# Инициализируем оба движка
-api_engine = build_text2sql()
-llm_engine = build_text2sql_local()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+STREAM_CHUNK_ROWS = 1000  # Строк в одном чанке потокового JSON ответа
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Заголовки потоковых NDJSON ответов: nginx (X-Accel-Buffering) и кэширующие прокси не копят ответ,
+# каждый батч уходит клиенту сразу
+NDJSON_HEADERS = {"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+# Форматы, результат которых можно отдавать потоком без сборки всего результата в памяти
+STREAMED_FORMATS = ("table", "graph", "diagram")
+# TIMEOUT -> упрощение запроса: подсказка для повторной генерации SQL (sql_hint - только в промпте SQL,
+# не в тексте запроса, истории и ключах кэшей)
+TIMEOUT_SIMPLIFY_HINT = "Previous SQL exceeded the time limit - simplify it: aggregate, filter by transaction_timestamp, add LIMIT"
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,8 +89,176 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _format_summary_value(value):
+    """Число для текстового ответа: разряды через пробел, float - два знака"""
+    if isinstance(value, bool) or value is None:
+        return str(value)
+    if isinstance(value, int):
+        return f"{value:,}".replace(",", " ")
+    if isinstance(value, float):
+        return f"{value:,.2f}".replace(",", " ")
+    return str(value)
+
+
+def _render_summary_template(template, rows):
+    """
+    Заполняет шаблон текстового ответа от LLM значениями результата без второго вызова LLM.
+    Столбцы берутся из единственной строки результата, {row_count} - число строк.
+    None - шаблон не подходит (нет шаблона, неизвестный плейсхолдер, несколько строк).
+    """
+    if not template:
+        return None
+    try:
+        fields = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+    except ValueError:
+        return None
+    values = {"row_count": _format_summary_value(len(rows))}
+    if fields - {"row_count"}:
+        if len(rows) != 1:
+            return None
+        values.update((key, _format_summary_value(value)) for key, value in rows[0].items())
+    if not fields <= values.keys():
+        return None
+    try:
+        return template.format_map(values)
+    except (ValueError, KeyError, IndexError):
+        # Спецификаторы формата или атрибуты в плейсхолдерах ({total:.2f}, {row.x})
+        return None
+
+
+def _stream_json_response(response_data):
+    """
+    Потоковая сериализация ответа: сначала поля ответа, затем массив data
+    чанками по STREAM_CHUNK_ROWS строк, без полной JSON-строки в памяти.
+    """
+    rows = response_data.pop("data")
+    head = orjson.dumps(response_data)
+    yield head[:-1] + b',"data":['
+    for start in range(0, len(rows), STREAM_CHUNK_ROWS):
+        chunk = orjson.dumps(rows[start:start + STREAM_CHUNK_ROWS])[1:-1]
+        yield chunk if start == 0 else b"," + chunk
+    yield b"]}"
+
+
+def _clarification_response(final_response: FinalResponse) -> ORJSONResponse:
+    """Ответ с уточняющим вопросом вместо данных"""
+    return ORJSONResponse(content={
+        "content": final_response.content,
+        "output_format": final_response.output_format,
+        "data": None,
+        "row_count": 0,
+        "execution_time_ms": 0,
+        "metadata": final_response.metadata
+    })
+
+
+def _response_sql(final_response: FinalResponse) -> str:
+    """SQL ответа пайплайна (ответ - не уточняющий вопрос); пустой SQL - ошибка запроса"""
+    sql_query = final_response.metadata.get("sql_query", final_response.content)
+    if not sql_query:
+        raise HTTPException(status_code=400, detail="Failed to generate SQL from the query")
+    return sql_query
+
+
+async def _regenerate_simplified(engine, req: UserQuery, timed_out_sql: str) -> FinalResponse:
+    """
+    Одна повторная генерация SQL с просьбой упростить запрос после таймаута.
+    SQL, не уложившийся во время, убирается из кэшей движка - повтор вопроса не получит его снова
+    """
+    engine.evict_cached_sql(timed_out_sql)
+    final_response = await engine.process_user_request(req, sql_hint=TIMEOUT_SIMPLIFY_HINT)
+    logger.debug("Regenerated SQL: %s", final_response.metadata.get("sql_query"))
+    return final_response
+
+
+async def _open_batches(sql_query: str, query: str, summary: dict):
+    """
+    Запускает потоковое выполнение и дожидается первого батча, чтобы ошибки
+    безопасности и таймауты превратились в HTTP статус до начала ответа.
+    """
+    # Потоком отдаются только STREAMED_FORMATS - их значения округляются, как в таблице
+    batches = stream_execute_sql_query(sql_query, query, summary, round_floats=True)
+    try:
+        first_batch = await anext(batches, [])
+    except BaseException:
+        await batches.aclose()
+        raise
+    return batches, first_batch
+
+
+async def _translated_columns(engine, columns, query: str, user_id: str):
+    """Перевод названий столбцов один раз по пустой строке-образцу, а не по всему результату"""
+    sample = await engine.translate_column_names([dict.fromkeys(columns)], query, user_id)
+    translated = list(sample[0].keys()) if sample else columns
+    # Если перевод склеил столбцы, оставляем оригинальные названия
+    return translated if len(translated) == len(columns) else columns
+
+
+async def _stream_ndjson_response(engine, final_response: FinalResponse, batches, first_batch, summary: dict, query: str, user_id: str, start_time: float):
+    """
+    NDJSON ответ: первая строка - поля ответа, далее по строке-массиву на батч курсора,
+    последняя строка - итоговые row_count, execution_time_ms и truncated.
+    """
+    try:
+        yield orjson.dumps({
+            "content": final_response.content,
+            "output_format": final_response.output_format,
+            "metadata": final_response.metadata
+        }) + b"\n"
+        
+        columns = translated = None
+        row_count = 0
+        batch = first_batch
+        while True:
+            if batch:
+                if columns is None:
+                    columns = list(batch[0].keys())
+                    translated = await _translated_columns(engine, columns, query, user_id)
+                if translated != columns:
+                    batch = [dict(zip(translated, row.values())) for row in batch]
+                row_count += len(batch)
+                yield orjson.dumps(batch) + b"\n"
+            batch = await anext(batches, None)
+            if batch is None:
+                break
+        
+        yield orjson.dumps({
+            "row_count": row_count,
+            "execution_time_ms": (time.time() - start_time) * 1000,
+            "truncated": summary.get("truncated", False)
+        }) + b"\n"
+    except Exception as e:
+        # Заголовки уже отправлены - сообщаем об ошибке последней строкой
+        logger.exception("Error streaming result: %s", e)
+        yield orjson.dumps({"error": str(e)}) + b"\n"
+    finally:
+        await batches.aclose()
+
+
+async def _stream_text_ndjson_response(engine, final_response: FinalResponse, execution_result, query: str, user_id: str):
+    """
+    NDJSON текстовый ответ: первая строка - поля ответа, далее по строке {"text": часть}
+    по мере генерации LLM, последняя строка - итоговые row_count, execution_time_ms и truncated.
+    """
+    try:
+        yield orjson.dumps({
+            "output_format": final_response.output_format,
+            "metadata": final_response.metadata
+        }) + b"\n"
+        async for part in engine.stream_text_response(query, execution_result.data, user_id):
+            yield orjson.dumps({"text": part}) + b"\n"
+        yield orjson.dumps({
+            "row_count": 1,
+            "execution_time_ms": execution_result.execution_time_ms,
+            "truncated": execution_result.truncated
+        }) + b"\n"
+    except Exception as e:
+        logger.exception("Error streaming text response: %s", e)
+        yield orjson.dumps({"error": str(e)}) + b"\n"
+
+
 @app.post("/process-text")
-async def process_text_stream(req: UserQuery):
+async def process_text_stream(req: UserQuery, request: Request):
     """Обработка запроса с использованием production контракта и поддержкой контекста"""
     query = req.natural_language_query.strip()
     if not query:
@@ -30,44 +266,81 @@ async def process_text_stream(req: UserQuery):
     
     # Выбираем движок в зависимости от параметра model
     if req.model == "api":
-        engine = api_engine
-        print(f"Using API engine (Gemini) for user {req.user_id}")
+        engine = request.app.state.api_engine
+        logger.debug("Using API engine (Gemini) for user %s", req.user_id)
     else:  # "llm" или по умолчанию
-        engine = llm_engine
-        print(f"Using LLM engine (Ollama) for user {req.user_id}")
+        engine = request.app.state.llm_engine
+        logger.debug("Using LLM engine (Ollama) for user %s", req.user_id)
     
-    print(f"Received query from user {req.user_id}: {query}")
+    logger.info("Received query from user %s: %s", req.user_id, query)
 
     try:
         final_response: FinalResponse = await engine.process_user_request(req)
         
         if final_response.metadata.get("requires_clarification", False):
-            return JSONResponse(content={
-                "content": final_response.content,
-                "output_format": final_response.output_format,
-                "data": None,
-                "row_count": 0,
-                "execution_time_ms": 0,
-                "metadata": final_response.metadata
-            })
+            return _clarification_response(final_response)
         
-        sql_query = final_response.metadata.get("sql_query", final_response.content)
+        sql_query = _response_sql(final_response)
         
-        if not sql_query:
-            raise HTTPException(status_code=400, detail="Failed to generate SQL from the query")
+        logger.debug("Generated SQL: %s", sql_query)
         
-        print("Generated SQL:", sql_query)
+        # Клиент, принимающий NDJSON, получает таблицу по мере чтения курсора
+        if (final_response.output_format in STREAMED_FORMATS
+                and NDJSON_MEDIA_TYPE in request.headers.get("accept", "")):
+            start_time = time.time()
+            summary = {}
+            try:
+                batches, first_batch = await _open_batches(sql_query, query, summary)
+            except QueryTimeoutException as e:
+                logger.warning("SQL timed out, regenerating simplified query: %s", e)
+                final_response = await _regenerate_simplified(engine, req, sql_query)
+                if final_response.metadata.get("requires_clarification", False):
+                    return _clarification_response(final_response)
+                sql_query = _response_sql(final_response)
+                start_time = time.time()
+                batches, first_batch = await _open_batches(sql_query, query, summary)
+            return StreamingResponse(
+                _stream_ndjson_response(engine, final_response, batches, first_batch, summary, query, req.user_id, start_time),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers=NDJSON_HEADERS
+            )
         
-        execution_result = await execute_sql_query(sql_query, query)
+        try:
+            execution_result = await execute_sql_query(
+                sql_query, query, round_floats=final_response.output_format in STREAMED_FORMATS
+            )
+        except QueryTimeoutException as e:
+            # Одна повторная генерация с просьбой упростить запрос
+            logger.warning("SQL timed out, regenerating simplified query: %s", e)
+            final_response = await _regenerate_simplified(engine, req, sql_query)
+            if final_response.metadata.get("requires_clarification", False):
+                return _clarification_response(final_response)
+            sql_query = _response_sql(final_response)
+            execution_result = await execute_sql_query(
+                sql_query, query, round_floats=final_response.output_format in STREAMED_FORMATS
+            )
         
         processed_data = execution_result.data
         text_content = final_response.content
         if final_response.output_format == "text":
-            text_response = await engine.format_text_response(
-                query,
-                execution_result.data,
-                req.user_id
+            # Шаблон из вызова генерации SQL заполняется локально; LLM - только если шаблон не подошел
+            text_response = _render_summary_template(
+                final_response.metadata.get("summary_template"),
+                execution_result.data
             )
+            if text_response is None and NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+                # Клиент, принимающий NDJSON, получает текст по мере генерации, а не после всего ответа LLM
+                return StreamingResponse(
+                    _stream_text_ndjson_response(engine, final_response, execution_result, query, req.user_id),
+                    media_type=NDJSON_MEDIA_TYPE,
+                    headers=NDJSON_HEADERS
+                )
+            if text_response is None:
+                text_response = await engine.format_text_response(
+                    query,
+                    execution_result.data,
+                    req.user_id
+                )
             text_content = text_response
             processed_data = [{"text": text_response}]
         elif final_response.output_format in ["table", "graph", "diagram"]:
@@ -76,10 +349,6 @@ async def process_text_stream(req: UserQuery):
                 query,
                 req.user_id
             )
-            for row in processed_data:
-                for key, value in row.items():
-                    if isinstance(value, float):
-                        row[key] = round(value, 2)
         
         response_data = {
             "content": text_content if final_response.output_format == "text" else final_response.content,
@@ -90,16 +359,21 @@ async def process_text_stream(req: UserQuery):
             "metadata": {
                 **final_response.metadata,
                 "execution_time_ms": execution_result.execution_time_ms,
-                "row_count": len(processed_data) if final_response.output_format == "text" else execution_result.row_count
+                "row_count": len(processed_data) if final_response.output_format == "text" else execution_result.row_count,
+                "truncated": execution_result.truncated
             }
         }
         
-        return JSONResponse(content=response_data)
+        return StreamingResponse(_stream_json_response(response_data), media_type="application/json")
         
+    except HTTPException:
+        raise
     except SecurityException as e:
         raise HTTPException(status_code=403, detail=str(e))
+    except QueryTimeoutException as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        print(f"Error processing request: {e}")
+        logger.exception("Error processing request: %s", e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 class ClearHistoryRequest(BaseModel):
@@ -107,12 +381,12 @@ class ClearHistoryRequest(BaseModel):
 
 
 @app.post("/clear-history")
-async def clear_history(req: ClearHistoryRequest):
+async def clear_history(req: ClearHistoryRequest, request: Request):
     """Очистка истории диалога для пользователя"""
     try:
         # Очищаем историю в обоих движках
-        api_engine._clear_history(req.user_id)
-        #llm_engine._clear_history(req.user_id)
-        return JSONResponse(content={"message": f"History cleared for user {req.user_id}"})
+        request.app.state.api_engine._clear_history(req.user_id)
+        #request.app.state.llm_engine._clear_history(req.user_id)
+        return ORJSONResponse(content={"message": f"History cleared for user {req.user_id}"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing history: {str(e)}")
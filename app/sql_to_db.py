@@ -1,176 +1,321 @@
+import asyncio
 import re
 import time
-from typing import List, Dict, Any, Optional
-from datetime import date, datetime
+from collections import deque
+from functools import lru_cache
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
+from datetime import date, datetime, time as dt_time
 from decimal import Decimal
-from sqlalchemy import create_engine, text
-from app.config import DATABASE_URL
+import sqlglot
+from psycopg import errors as pg_errors
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.tokens import TokenType
+from sqlalchemy import TextClause, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.config import (
+    DATABASE_URL, DB_SESSION_OPTIONS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+)
+from app.constants import ROLLUP_VIEW
 from app.models import ExecutionResult
-from app.security_validator import SecurityValidator, SecurityException
+from app.security_validator import SecurityException, security_validator
 
 BATCH_SIZE = 50000  # Максимальный размер батча
 MAX_RESULT_ROWS = 10000  # Максимальное количество строк результата
+FLOAT_DIGITS = 2  # Знаков после запятой для float/numeric столбцов результата
 
-security_validator = SecurityValidator()
+# Один async engine с пулом соединений на процесс (вместо create_engine на каждый запрос)
+engine = create_async_engine(
+    DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    connect_args={
+        "prepare_threshold": 0,
+        "options": DB_SESSION_OPTIONS
+    }
+)
+
+
+class QueryTimeoutException(Exception):
+    """Запрос прерван по statement_timeout"""
+    pass
+
+# Сравнения, строковый литерал справа от которых выносится в bind-параметр: merchant_city = 'Astana',
+# mcc_category ILIKE '%food%'. Литералы в других позициях (INTERVAL '1 month', DATE_TRUNC('month', ...),
+# '2024-01-01'::date) не трогаем: одинаковые выражения в SELECT и GROUP BY должны остаться одинаковыми
+# для планировщика, а у литерала под CAST тип задает сам запрос
+_PARAMETERIZED_COMPARISONS = (exp.EQ, exp.NEQ, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Like, exp.ILike)
+
+# LIMIT n [OFFSET m] - запасной вариант, если sqlglot не разобрал запрос
+_LIMIT_RE = re.compile(r'\bLIMIT\s+(\d+)\s*(?:OFFSET\s+\d+)?', re.IGNORECASE)
+
+
+# Типы, которые orjson сериализует нативно (datetime/date/time - в ISO 8601) - отдаются как есть
+_NATIVE_JSON_TYPES = frozenset({type(None), bool, int, float, str, datetime, date, dt_time})
 
 
 def _convert_to_json_serializable(value: Any) -> Any:
     """
     Преобразует значение в JSON-совместимый тип.
-    Обрабатывает Decimal, datetime, date и другие типы.
+    Нативные для orjson типы возвращаются без изменений, Decimal -> float, остальное -> str.
     """
-    if value is None:
-        return None
+    if type(value) in _NATIVE_JSON_TYPES:
+        return value
     if isinstance(value, Decimal):
         return float(value)
-    if isinstance(value, (datetime, date)):
-        return value.isoformat()
-    if isinstance(value, (int, float, str, bool)):
-        return value
     return str(value)
 
 
+def _round_values(values, ndigits: int = FLOAT_DIGITS) -> tuple:
+    """Округление столбца float (Decimal приводятся к float), NULL остаются NULL"""
+    return tuple(None if value is None else round(float(value), ndigits) for value in values)
 
-def _has_limit_in_query(sql_query: str) -> bool:
+
+def _rows_to_dicts(columns: List[str], rows, round_floats: bool = False) -> List[Dict[str, Any]]:
     """
-    Проверяет, есть ли LIMIT в SQL запросе (включая подзапросы).
-    Если есть LIMIT, батчинг может нарушить логику запроса.
+    Собирает строки батча в dict с конвертацией по столбцам, а не по ячейкам.
+    Тип столбца в PostgreSQL один для всех строк, поэтому он определяется по первому
+    не-NULL значению: с round_floats float и Decimal столбцы округляются до FLOAT_DIGITS знаков,
+    без него Decimal только приводятся к float; прочие нативные для orjson типы не конвертируются вовсе.
     """
-    query_upper = sql_query.upper()
-    return bool(re.search(r'\bLIMIT\s+\d+', query_upper, re.IGNORECASE))
+    if not rows:
+        return []
+    column_values = list(zip(*rows))
+    converted = False
+    for index, values in enumerate(column_values):
+        sample = next((value for value in values if value is not None), None)
+        if round_floats and isinstance(sample, (float, Decimal)):
+            column_values[index] = _round_values(values)
+        elif type(sample) in _NATIVE_JSON_TYPES:
+            continue
+        else:
+            column_values[index] = tuple(map(_convert_to_json_serializable, values))
+        converted = True
+    if converted:
+        rows = zip(*column_values)
+    return [dict(zip(columns, row)) for row in rows]
 
 
-def _extract_limit_from_query(sql_query: str) -> Optional[int]:
+def _parameterize_literals(sql_query: str) -> Tuple[str, Dict[str, str]]:
     """
-    Извлекает значение последнего (внешнего) LIMIT из SQL запроса.
-    Если LIMIT есть в подзапросе, это тоже важно - батчинг может нарушить логику.
+    Выносит строковые литералы сравнений в bind-параметры.
+    Запросы одной формы с разными значениями получают одинаковый текст,
+    и PostgreSQL переиспользует подготовленный statement и его план.
+    Литералы ищутся в дереве sqlglot, поэтому кавычки внутри строк и комментарии не мешают;
+    запрос, который sqlglot не разобрал, выполняется как есть.
     """
-    query_upper = sql_query.upper()
+    tree = _parse_sql(sql_query)
+    if tree is None:
+        return sql_query, {}
     
-    limit_matches = list(re.finditer(r'\bLIMIT\s+(\d+)', query_upper, re.IGNORECASE))
-    if not limit_matches:
-        return None
+    # Дерево из кэша _parse_sql не меняем
+    tree = tree.copy()
+    params: Dict[str, str] = {}
+    for literal in list(tree.find_all(exp.Literal)):
+        if (
+            literal.is_string
+            and literal.arg_key == "expression"
+            and isinstance(literal.parent, _PARAMETERIZED_COMPARISONS)
+        ):
+            name = f"p{len(params)}"
+            params[name] = literal.this
+            literal.replace(exp.var(f":{name}"))
     
-    last_limit = limit_matches[-1]
-    limit_value = int(last_limit.group(1))
-    return limit_value
+    if not params:
+        return sql_query, params
+    return tree.sql(dialect="postgres"), params
 
 
-def _add_limit_offset(sql_query: str, limit: int, offset: int) -> str:
+@lru_cache(maxsize=1024)
+def _parse_sql(sql_query: str) -> Optional[exp.Expression]:
+    """Разбор SQL в дерево sqlglot (диалект PostgreSQL); None, если запрос не разобрался"""
+    try:
+        return sqlglot.parse_one(sql_query, read="postgres")
+    except SqlglotError:
+        return None
+
+
+def _extract_limit_from_query(sql_query: str) -> Optional[int]:
     """
-    Добавляет или модифицирует LIMIT и OFFSET в SQL запросе.
+    Извлекает значение внешнего LIMIT (или FETCH FIRST n ROWS) из SQL запроса.
+    LIMIT в подзапросах и CTE, в строковых литералах и комментариях не учитывается.
+    None - внешнего LIMIT нет (или это LIMIT ALL / выражение).
     """
-    query_upper = sql_query.upper()
+    tree = _parse_sql(sql_query)
+    if tree is None:
+        last_limit = deque(_LIMIT_RE.finditer(sql_query), maxlen=1)
+        return int(last_limit[0].group(1)) if last_limit else None
     
-    limit_match = list(re.finditer(r'\bLIMIT\s+\d+', query_upper, re.IGNORECASE))
-    if limit_match:
-        last_limit = limit_match[-1]
-        start_pos = last_limit.start()
-        remaining = sql_query[start_pos:]
-        offset_match = re.search(r'\s+OFFSET\s+\d+', remaining, re.IGNORECASE)
-        if offset_match:
-            end_pos = start_pos + offset_match.end()
-            sql_query = sql_query[:start_pos] + sql_query[end_pos:]
-        else:
-            sql_query = sql_query[:start_pos] + sql_query[last_limit.end():]
-    
-    sql_query = sql_query.rstrip().rstrip(';')
-    return f"{sql_query} LIMIT {limit} OFFSET {offset}"
+    limit = tree.args.get("limit")
+    if isinstance(limit, exp.Fetch):
+        value = limit.args.get("count")
+    elif isinstance(limit, exp.Limit):
+        value = limit.expression
+    else:
+        return None
+    if isinstance(value, exp.Literal) and value.is_int:
+        return int(value.this)
+    return None
 
 
-async def execute_sql_query(sql_query: str, user_intent: str = "") -> ExecutionResult:
+@lru_cache(maxsize=1024)
+def _statement(sql_query: str) -> TextClause:
     """
-    Выполняет SQL запрос с валидацией и возвращает ExecutionResult.
-    Оптимизировано для больших результатов: обрабатывает батчами.
+    Один TextClause на текст запроса: после выноса литералов в параметры запросы одной формы
+    совпадают, SQLAlchemy берет скомпилированную форму из кэша, а psycopg - уже подготовленный statement.
+    """
+    return text(sql_query)
+
+
+def _strip_statement_end(sql_query: str) -> str:
+    """
+    Запрос без завершающих точек с запятой и комментариев после них (SELECT ...; -- note).
+    Конец запроса - последний токен sqlglot, кроме ';': ';' внутри строк и комментариев не мешают
+    """
+    try:
+        tokens = sqlglot.tokenize(sql_query, read="postgres")
+    except SqlglotError:
+        return sql_query.strip().rstrip(";")
+    end = next((token.end for token in reversed(tokens) if token.token_type != TokenType.SEMICOLON), None)
+    return sql_query[:end + 1] if end is not None else sql_query.strip().rstrip(";")
+
+
+def _bound_query(sql_query: str, limit: int) -> str:
+    """
+    Ограничивает результат запроса на стороне PostgreSQL внешним LIMIT.
+    Запрос оборачивается в подзапрос, поэтому работает и для CTE, UNION и запросов со своим LIMIT;
+    перенос строки перед скобкой не дает комментарию -- внутри запроса съесть ее.
+    """
+    return f"SELECT * FROM (\n{_strip_statement_end(sql_query)}\n) AS bounded_result LIMIT {limit}"
+
+
+def _discard_task_result(task: asyncio.Task):
+    """Забирает результат завершенной задачи, которую больше никто не ждет"""
+    if not task.cancelled():
+        task.exception()
+
+
+async def stream_execute_sql_query(
+    sql_query: str,
+    user_intent: str = "",
+    summary: Optional[Dict[str, Any]] = None,
+    round_floats: bool = False
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Выполняет SQL запрос с валидацией и отдает результат батчами по мере чтения курсора.
+    В памяти держится только текущий батч, первые строки доступны до окончания запроса.
     
     Args:
         sql_query: SQL запрос в виде строки
         user_intent: Оригинальный запрос пользователя для валидации
+        summary: Необязательный dict, в который по окончании записывается truncated -
+            был ли результат обрезан до MAX_RESULT_ROWS
+        round_floats: Округлять float/numeric столбцы до FLOAT_DIGITS знаков (таблицы и графики);
+            текстовым ответам нужны точные значения
         
-    Returns:
-        ExecutionResult с данными и метаинформацией
+    Yields:
+        Списки строк (dict) не длиннее BATCH_SIZE, в сумме не больше MAX_RESULT_ROWS
     """
-    start_time = time.time()
-    engine = create_engine(DATABASE_URL)
+    # Проверка безопасности идет в потоке, пока соединение берется из пула (или открывается);
+    # запрос отправляется только после ее завершения
+    validation_task = asyncio.create_task(
+        asyncio.to_thread(security_validator.validate_sql, sql_query, user_intent)
+    )
     
-    validation = security_validator.validate_sql(sql_query, user_intent)
-    if not validation.is_safe:
-        raise SecurityException(f"Query violates security policy: {validation.validation_notes}")
+    query_limit = _extract_limit_from_query(sql_query)
+    sql_query, params = _parameterize_literals(sql_query)
+    truncated = False
     
-    with engine.connect() as connection:
-        has_limit = _has_limit_in_query(sql_query)
-        query_limit = _extract_limit_from_query(sql_query)
-        
-        if has_limit:
-            try:
-                result = connection.execute(text(sql_query))
-                columns = list(result.keys())
-                rows = result.fetchall()
-                
-                all_data: List[Dict[str, Any]] = []
-                for row in rows:
-                    row_dict = {
-                        col: _convert_to_json_serializable(row[i]) 
-                        for i, col in enumerate(columns)
-                    }
-                    all_data.append(row_dict)
-                
-                execution_time_ms = (time.time() - start_time) * 1000
-                
-                return ExecutionResult(
-                    data=all_data,
-                    row_count=len(all_data),
-                    execution_time_ms=execution_time_ms
-                )
-            except Exception as e:
-                raise Exception(f"SQL execution error: {str(e)}")
-        
-        all_data: List[Dict[str, Any]] = []
-        offset = 0
-        total_rows = 0
-        
-        while True:
-            paginated_query = _add_limit_offset(sql_query, BATCH_SIZE, offset)
+    try:
+        async with engine.connect() as connection:
+            validation = await validation_task
+            if not validation.is_safe:
+                raise SecurityException(f"Query violates security policy: {validation.validation_notes}")
             
             try:
-                result = connection.execute(text(paginated_query))
-                
-                if offset == 0:
+                if query_limit is not None and query_limit <= MAX_RESULT_ROWS:
+                    # Запрос уже ограничен небольшим LIMIT - читаем одним fetchall без серверного курсора
+                    result = await connection.execute(_statement(sql_query), params)
+                    columns = list(result.keys())
+                    yield _rows_to_dicts(columns, result.fetchall(), round_floats)
+                else:
+                    # Граница MAX_RESULT_ROWS + 1 уходит в SQL: PostgreSQL не производит лишних строк,
+                    # а лишняя строка показывает, что результат обрезан
+                    bounded_sql = _bound_query(sql_query, MAX_RESULT_ROWS + 1)
+                    result = await connection.stream(_statement(bounded_sql), params)
                     columns = list(result.keys())
-                
-                rows = result.fetchall()
-                
-                if not rows:
-                    break
-                
-                for row in rows:
-                    row_dict = {
-                        col: _convert_to_json_serializable(row[i]) 
-                        for i, col in enumerate(columns)
-                    }
-                    all_data.append(row_dict)
-                
-                total_rows += len(rows)
-                
-                if total_rows >= MAX_RESULT_ROWS:
-                    all_data = all_data[:MAX_RESULT_ROWS]
-                    break
-                
-                if len(rows) < BATCH_SIZE:
-                    break
-                
-                offset += BATCH_SIZE
-                
+                    remaining = MAX_RESULT_ROWS
+                    
+                    async for rows in result.partitions(BATCH_SIZE):
+                        if len(rows) > remaining:
+                            rows = rows[:remaining]
+                            truncated = True
+                        remaining -= len(rows)
+                        if rows:
+                            yield _rows_to_dicts(columns, rows, round_floats)
+                    
+                    await result.close()
+            
+            except OperationalError as e:
+                if isinstance(e.orig, pg_errors.QueryCanceled):
+                    raise QueryTimeoutException(f"SQL execution timeout: {str(e.orig)}")
+                raise Exception(f"SQL execution error: {str(e)}")
             except Exception as e:
                 raise Exception(f"SQL execution error: {str(e)}")
-        
-        execution_time_ms = (time.time() - start_time) * 1000
-        
-        return ExecutionResult(
-            data=all_data,
-            row_count=len(all_data),
-            execution_time_ms=execution_time_ms
+    finally:
+        # Если соединение получить не удалось, проверка больше не нужна. cancel() не останавливает поток
+        # to_thread, поэтому исключение проверки забирается в callback - без "exception was never retrieved"
+        validation_task.cancel()
+        validation_task.add_done_callback(_discard_task_result)
+    
+    if summary is not None:
+        summary["truncated"] = truncated
+
+
+async def rollup_view_exists() -> bool:
+    """Проверка при старте сервера: создан ли materialized view дневных агрегатов (create_rollups.py)"""
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            text("SELECT 1 FROM pg_matviews WHERE matviewname = :name"), {"name": ROLLUP_VIEW}
         )
+        return result.scalar() is not None
+
+
+async def execute_sql_query(sql_query: str, user_intent: str = "", round_floats: bool = False) -> ExecutionResult:
+    """
+    Выполняет SQL запрос с валидацией и возвращает ExecutionResult.
+    Собирает батчи stream_execute_sql_query в один список - нужен там, где требуется весь результат.
+    
+    Args:
+        sql_query: SQL запрос в виде строки
+        user_intent: Оригинальный запрос пользователя для валидации
+        round_floats: Округлять float/numeric столбцы до FLOAT_DIGITS знаков
+        
+    Returns:
+        ExecutionResult с данными и метаинформацией
+    """
+    start_time = time.time()
+    
+    all_data: List[Dict[str, Any]] = []
+    summary: Dict[str, Any] = {}
+    async for batch in stream_execute_sql_query(sql_query, user_intent, summary, round_floats):
+        all_data.extend(batch)
+    
+    execution_time_ms = (time.time() - start_time) * 1000
+    
+    # Строки собраны нами же и уже JSON-совместимы — валидация pydantic по каждой строке не нужна
+    return ExecutionResult.model_construct(
+        data=all_data,
+        row_count=len(all_data),
+        execution_time_ms=execution_time_ms,
+        truncated=summary.get("truncated", False)
+    )
 
 
 def execute_sql_query_sync(sql_query: str):
@@ -178,9 +323,15 @@ def execute_sql_query_sync(sql_query: str):
     Синхронная версия для обратной совместимости.
     Выполняет SQL запрос и выводит результат в консоль.
     """
-    import asyncio
+    async def run() -> ExecutionResult:
+        try:
+            return await execute_sql_query(sql_query)
+        finally:
+            # Соединения пула привязаны к event loop, который закроет asyncio.run
+            await engine.dispose()
+    
     try:
-        result = asyncio.run(execute_sql_query(sql_query))
+        result = asyncio.run(run())
         
         if not result.data:
             print("Нет данных для отображения.")
@@ -0,0 +1,16 @@
+import sqlalchemy
+from app.config import DATABASE_URL
+from app.models import Transaction
+
+# Индексы создаются CONCURRENTLY, чтобы не блокировать таблицу transactions на запись.
+# CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции, поэтому AUTOCOMMIT.
+engine = sqlalchemy.create_engine(DATABASE_URL)
+
+with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+    for index in Transaction.__table__.indexes:
+        columns = ", ".join(column.name for column in index.columns)
+        conn.execute(sqlalchemy.text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} "
+            f"ON {Transaction.__tablename__} ({columns})"
+        ))
+        print(f"Index {index.name} ({columns}) ready")
@@ -0,0 +1,45 @@
+import sqlalchemy
+from app.config import DATABASE_URL
+from app.constants import ROLLUP_VIEW
+
+# Дневные агрегаты для типовых дашбордных запросов (город / категория / тип транзакции).
+# Первый запуск создает materialized view, последующие - обновляют его REFRESH MATERIALIZED VIEW CONCURRENTLY.
+# CONCURRENTLY требует уникальный индекс и не блокирует чтение view во время обновления.
+# Обновление - по расписанию после загрузки данных, например cron раз в час:
+#   0 * * * * cd /path/to/text2sql-bot && venv/bin/python create_rollups.py
+# Сервер проверяет наличие view при старте и только тогда описывает его в промптах генерации SQL:
+# после первого создания view сервер нужно перезапустить.
+engine = sqlalchemy.create_engine(DATABASE_URL)
+
+CREATE_VIEW = f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS {ROLLUP_VIEW} AS
+SELECT
+    date_trunc('day', transaction_timestamp) AS day,
+    merchant_city,
+    mcc_category,
+    transaction_type,
+    SUM(transaction_amount_kzt) AS total_amount_kzt,
+    COUNT(*) AS transaction_count
+FROM transactions
+GROUP BY 1, 2, 3, 4
+"""
+
+with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+    exists = conn.execute(
+        sqlalchemy.text("SELECT 1 FROM pg_matviews WHERE matviewname = :name"),
+        {"name": ROLLUP_VIEW}
+    ).scalar()
+
+    if not exists:
+        conn.execute(sqlalchemy.text(CREATE_VIEW))
+        conn.execute(sqlalchemy.text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{ROLLUP_VIEW}_key "
+            f"ON {ROLLUP_VIEW} (day, merchant_city, mcc_category, transaction_type)"
+        ))
+        conn.execute(sqlalchemy.text(
+            f"CREATE INDEX IF NOT EXISTS ix_{ROLLUP_VIEW}_day_city ON {ROLLUP_VIEW} (day, merchant_city)"
+        ))
+        print(f"Materialized view {ROLLUP_VIEW} created")
+    else:
+        conn.execute(sqlalchemy.text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {ROLLUP_VIEW}"))
+        print(f"Materialized view {ROLLUP_VIEW} refreshed")
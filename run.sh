@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-uvicorn app.server:app --host 0.0.0.0 --port 8001 &
\ No newline at end of file
+uvicorn app.server:app --host 0.0.0.0 --port 8001 --loop uvloop --http httptools &
\ No newline at end of file
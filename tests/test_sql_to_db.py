@@ -0,0 +1,42 @@
+from app.sql_to_db import _bound_query, _parameterize_literals
+
+
+def test_cast_literal_stays_inline():
+    sql, params = _parameterize_literals(
+        "SELECT * FROM transactions WHERE transaction_timestamp >= '2024-01-01'::date AND merchant_city = 'Astana'"
+    )
+    assert params == {"p0": "Astana"}
+    assert "CAST('2024-01-01' AS DATE)" in sql
+    assert "merchant_city = :p0" in sql
+
+
+def test_cast_function_literal_stays_inline():
+    sql, params = _parameterize_literals(
+        "SELECT COUNT(*) FROM transactions WHERE transaction_timestamp < CAST('2024-03-01' AS TIMESTAMP)"
+    )
+    assert params == {}
+    assert "CAST('2024-03-01' AS TIMESTAMP)" in sql
+
+
+def test_quotes_inside_string_and_comment():
+    sql, params = _parameterize_literals(
+        "SELECT * FROM transactions WHERE merchant_city = 'it''s = ''x''' -- = 'comment'\n"
+        "AND mcc_category NOT ILIKE '%food%'"
+    )
+    assert params == {"p0": "it's = 'x'", "p1": "%food%"}
+    assert "merchant_city = :p0" in sql
+    assert "ILIKE :p1" in sql
+
+
+def test_unparsed_query_is_unchanged():
+    assert _parameterize_literals("SELEC broken 'x'") == ("SELEC broken 'x'", {})
+
+
+def test_bound_query_drops_semicolon_before_trailing_comment():
+    sql = _bound_query("SELECT merchant_city FROM transactions; -- note", 10)
+    assert sql == "SELECT * FROM (\nSELECT merchant_city FROM transactions\n) AS bounded_result LIMIT 10"
+
+
+def test_bound_query_keeps_semicolon_inside_string():
+    sql = _bound_query("SELECT ';' AS sep FROM transactions;", 10)
+    assert "SELECT ';' AS sep FROM transactions\n)" in sql